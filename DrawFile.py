@@ -31,9 +31,10 @@ Completion Date: 2024.06.15
 
 
 import matplotlib.pyplot as plt
+import numpy as np
 
 
-# Assuming realresult is a list of 3D points after transformation (i.e., subtraction of plane reference)
+# Assuming realresult is an (N, 3) array of 3D points after transformation (i.e., subtraction of plane reference)
 # Let's add the function to plot the 2D scatter plot from realresult.
 
 def plot_2d_points(realresult):
@@ -41,17 +42,16 @@ def plot_2d_points(realresult):
     Plot the realresult points in a 2D plane (X-Y plane).
 
     Parameters:
-    - realresult: List of transformed points after subtracting the reference plane.
+    - realresult: (N, 3) numpy array, or list of 3D points, of transformed points after subtracting the reference plane.
 
-    This function extracts X and Y coordinates from each point in the 3D list and plots them.
+    This function takes the X and Y columns of the 3D points and plots them.
+    The scatter is rasterized so that saving a figure with many points stays fast.
     """
-    # Extracting X, Y coordinates from the 3D points
-    x_coords = [point[0] for point in realresult]
-    y_coords = [point[1] for point in realresult]
+    realresult = np.asarray(realresult)  # Accept a list of points as well as an (N, 3) array
 
     # Create a scatter plot of the X, Y coordinates
     plt.figure(figsize=(8, 8))
-    plt.scatter(x_coords, y_coords, c='blue', marker='o', s=50)
+    plt.scatter(realresult[:, 0], realresult[:, 1], c='blue', marker='o', s=50, rasterized=True)
 
     # Add labels and title to the plot
     plt.xlabel('X Position (mm)')
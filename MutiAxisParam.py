@@ -28,7 +28,12 @@ Completion Date: 2024.06.12
 '''
 
 
+import math
+
 import numpy as np
+from numba import njit, prange
+
+import RayData.ray_kernels as rk  # Import the numba kernels holding the ray-tracing math
 
 
 # Helper function to rotate a normal vector around a given axis using Rodrigues' formula
@@ -41,30 +46,25 @@ def rotate_normal_vector(normal_vector, angles):
     - angles (list): The rotation angles for X, Y, and Z axes in degrees.
 
     Returns:
-    - list: The rotated normal vector [a', b', c'].
+    - numpy array: The rotated normal vector [a', b', c'].
+
+    Notes:
+    - The rotations are applied about X first, then Y, then Z, i.e. R = Rz · Ry · Rx.
+      The product is written out in closed form so only one matrix-vector product is performed.
     """
     # Normalize the normal vector to unit length
-    normal_vector = np.array(normal_vector, dtype=np.float64) / np.linalg.norm(normal_vector)  # 确保法向量为单位向量
+    normal_vector = np.array(normal_vector, dtype=np.float64)
+    a, b, c = normal_vector
+    normal_vector = normal_vector / math.sqrt(a * a + b * b + c * c)  # 确保法向量为单位向量
     # Convert angles from degrees to radians
     angles_rad = np.radians(angles)
-    # Define the rotation matrices for each axis (X, Y, Z)
-    rotation_matrices = [
-        np.array([[1, 0, 0],
-                  [0, np.cos(angles_rad[0]), -np.sin(angles_rad[0])],
-                  [0, np.sin(angles_rad[0]), np.cos(angles_rad[0])]]),# X-axis rotation matrix
-        np.array([[np.cos(angles_rad[1]), 0, np.sin(angles_rad[1])],
-                  [0, 1, 0],
-                  [-np.sin(angles_rad[1]), 0, np.cos(angles_rad[1])]]),# Y-axis rotation matrix
-        np.array([[np.cos(angles_rad[2]), -np.sin(angles_rad[2]), 0],
-                  [np.sin(angles_rad[2]), np.cos(angles_rad[2]), 0],
-                  [0, 0, 1]])# Z-axis rotation matrix
-    ]
-    # Initialize the new normal vector as the original normal vector
-    new_normal_vector = np.array(normal_vector)
-    # Apply the rotation matrices sequentially for each axis
-    for rotation_matrix in rotation_matrices:
-        new_normal_vector = np.dot(rotation_matrix, new_normal_vector)
-    return list(new_normal_vector)
+    cx, cy, cz = np.cos(angles_rad)
+    sx, sy, sz = np.sin(angles_rad)
+    # Combined ZYX rotation matrix R = Rz · Ry · Rx
+    rotation_matrix = np.array([[cz * cy, cz * sy * sx - sz * cx, cz * sy * cx + sz * sx],
+                                [sz * cy, sz * sy * sx + cz * cx, sz * sy * cx - cz * sx],
+                                [-sy, cy * sx, cy * cx]])
+    return rotation_matrix @ normal_vector
 
 
 # Helper function for affine transformation (translation) of a point
@@ -89,6 +89,86 @@ def translate_position(position, translation_vector):
     return translated_position
 
 
+# Compiled ray tracing of a single ray through the system, the fused form of MultiAxisGalvanometer.trace
+@njit(fastmath=True, cache=True)
+def _trace_one(nx, ny, mirrors):
+    """
+    Traces one ray from the origin along +Y through the multi-axis galvanometer system.
+
+    Parameters:
+    - nx (np.array): Unit normal of the X-axis mirror, already rotated by its scan angle.
+    - ny (np.array): Unit normal of the Y-axis mirror, already rotated by its scan angle.
+    - mirrors (np.array): The (6, 2, 3) unit normals and points of the surfaces, see MultiAxisGalvanometer.__init__.
+
+    Returns:
+    - tuple: The intersection point (x, y, z) with the focusing plane, NaN if the ray misses any surface.
+
+    Notes:
+    - The ray only lives in local scalars; the rk kernels are compiled inline, so nothing is allocated.
+    """
+    position = (0.0, 0.0, 0.0)  # Starting position of the ray (origin)
+    direction = (0.0, 1.0, 0.0)  # Direction of the ray (in the positive Y-axis direction)
+
+    missed = False  # Whether the ray missed one of the surfaces, as a NaN row of a traced batch
+
+    # Step 1 and 2: First and second mirrors (Pi_1, Pi_2)
+    for k in range(2):
+        position, hit = rk.interact(position, direction, mirrors[k, 0], mirrors[k, 1])
+        missed = missed or not hit
+        direction = rk.reflect(direction, mirrors[k, 0])
+
+    # Step 3: X-Y Scanning mirrors
+    position, hit = rk.interact(position, direction, nx, mirrors[2, 1])
+    missed = missed or not hit
+    direction = rk.reflect(direction, nx)
+    position, hit = rk.interact(position, direction, ny, mirrors[3, 1])
+    missed = missed or not hit
+    direction = rk.reflect(direction, ny)
+
+    # Step 4: Refraction at the field lens
+    position, hit = rk.interact(position, direction, mirrors[4, 0], mirrors[4, 1])
+    missed = missed or not hit
+    direction = rk.refract_k_minus_one(direction, mirrors[4, 0])  # Refraction with k = -1
+
+    # Step 5: Intersection with the focusing plane (Final output point)
+    position, hit = rk.interact(position, direction, mirrors[5, 0], mirrors[5, 1])
+    if missed or not hit:
+        return (np.nan, np.nan, np.nan)
+    return position
+
+
+# Compiled ray tracing of a whole grid of scan angles, spread over all cores with numba's prange
+@njit(parallel=True, cache=True)
+def _trace_grid(valuex, valuey, mirrors, scan_axes):
+    """
+    Traces one ray per (X, Y) pair of the grid valuex x valuey.
+
+    Returns:
+    - numpy array: The (len(valuex) * len(valuey), 3) intersection points, X-major.
+
+    Notes:
+    - Each scan angle is shared by a whole row or column of the grid, so the rotated mirror normals are
+      tabulated once per angle (len(valuex) + len(valuey) rotations) instead of once per ray.
+    - The rays are independent, so prange spreads the flattened grid over all cores; splitting on the points
+      instead of the X rows keeps every core busy even when len(valuex) is small.
+    """
+    num_x = len(valuex)
+    num_y = len(valuey)
+    nx_table = np.empty((num_x, 3))
+    for i in range(num_x):
+        nx_table[i, 0], nx_table[i, 1], nx_table[i, 2] = rk.rotate_axis(mirrors[2, 0], scan_axes[0], valuex[i] * math.pi / 180)
+    ny_table = np.empty((num_y, 3))
+    for j in range(num_y):
+        ny_table[j, 0], ny_table[j, 1], ny_table[j, 2] = rk.rotate_axis(mirrors[3, 0], scan_axes[1], valuey[j] * math.pi / 180)
+
+    points = np.empty((num_x * num_y, 3))
+    for k in prange(num_x * num_y):
+        i = k // num_y  # Index of the X angle
+        j = k % num_y  # Index of the Y angle
+        points[k, 0], points[k, 1], points[k, 2] = _trace_one(nx_table[i], ny_table[j], mirrors)
+    return points
+
+
 class MultiAxisGalvanometer:
     """
     Class to simulate the multi-axis galvanometer system, including ray tracing, reflection, refraction, and scanning with rotating mirrors.
@@ -100,11 +180,81 @@ class MultiAxisGalvanometer:
         Parameters:
         - focus_distance (float): The focus distance for the system.
         - galvo_gap (float): The gap between the galvanometer mirrors.
+
+        Notes:
+        - The geometry of every surface is built once here: self._mirrors holds the (unit normal, point) pair of the
+          first mirror, the second mirror, the X and Y scanning mirrors, the field lens and the focusing plane, in
+          tracing order, and self._scan_axes the unit rotation axes of the X and Y scanning mirrors.
+        - Mechanical errors of the surfaces are applied to this geometry once with calibrate.
+        - focus_distance and galvo_gap are read-only, since the geometry is built from them; create a new
+          MultiAxisGalvanometer to trace another configuration.
         """
-        self.focus_distance = focus_distance  # Focus distance
-        self.galvo_gap = galvo_gap  # Galvanometer gap
+        self._focus_distance = focus_distance  # Focus distance
+        self._galvo_gap = galvo_gap  # Galvanometer gap
         self.ray = None  # Ray object, initially set to None
 
+        n1 = [0, 1, -1]  # Normal vector for the first mirror
+        P1 = [0, 20, 0]  # Position of the first mirror
+        n2 = [0, 1, -1]  # Normal vector for the second mirror
+        P2 = [0, 20, 200]  # Position of the second mirror
+        nx = [-1, 1, 0]  # Normal vector for X scanning
+        Px1 = [0, 180, 200]  # Position of the first scanning mirror
+        ny = [1, 0, 1]  # Normal vector for Y scanning
+        Px2 = [galvo_gap, 180, 200]  # Position of the second scanning mirror
+        n5 = [0, 0, 1]  # Normal vector for the field lens
+        P5 = [galvo_gap, 180, 170]  # Position of the field lens
+        n = [0, 0, 1]  # Normal vector of the focusing plane
+        P = [galvo_gap, 180, 170 - focus_distance]  # A point on the focusing plane
+        rx = [0, 0, 1]  # Rotation axis for X mirror
+        ry = [0, 1, 0]  # Rotation axis for Y mirror
+
+        self._mirrors = np.array([[n1, P1], [n2, P2], [nx, Px1], [ny, Px2], [n5, P5], [n, P]], dtype=np.float64)
+        self._mirrors[:, 0] /= np.linalg.norm(self._mirrors[:, 0], axis=-1, keepdims=True)  # Pre-normalize the normals
+        self._scan_axes = np.array([rx, ry], dtype=np.float64)
+
+    @property
+    def focus_distance(self):
+        """
+        The focus distance for the system (read-only).
+        """
+        return self._focus_distance
+
+    @property
+    def galvo_gap(self):
+        """
+        The gap between the galvanometer mirrors (read-only).
+        """
+        return self._galvo_gap
+
+    def calibrate(self, rot_list, trans_list):
+        """
+        Applies rotations and translations of the surfaces, e.g. mechanical errors, to the system geometry.
+
+        Parameters:
+        - rot_list (list): For each surface, the rotation angles [rx, ry, rz] of its normal vector around the X, Y,
+          and Z axes in degrees, see rotate_normal_vector.
+        - trans_list (list): For each surface, the translation vector [dx, dy, dz] of its position, see translate_position.
+
+        Notes:
+        - The surfaces are taken in tracing order: first mirror, second mirror, X and Y scanning mirrors, field lens
+          and focusing plane. Shorter lists only calibrate the first surfaces.
+        - The geometry is updated once here, relative to its current state, so trace and trace_grid pay nothing per ray.
+        - A scanning mirror is rotated together with its rotation axis, so the axis stays fixed to the mirror.
+
+        Raises:
+        - ValueError: If rot_list and trans_list differ in length, or list more surfaces than the system has.
+        """
+        if len(rot_list) != len(trans_list):
+            raise ValueError("rot_list and trans_list must have the same length, got %d and %d"
+                             % (len(rot_list), len(trans_list)))
+        if len(rot_list) > len(self._mirrors):
+            raise ValueError("At most %d surfaces can be calibrated, got %d" % (len(self._mirrors), len(rot_list)))
+        for k, (angles, translation) in enumerate(zip(rot_list, trans_list)):
+            self._mirrors[k, 0] = rotate_normal_vector(self._mirrors[k, 0], angles)  # Unit normal after rotation
+            self._mirrors[k, 1] = translate_position(self._mirrors[k, 1], translation)
+            if k in (2, 3):
+                self._scan_axes[k - 2] = rotate_normal_vector(self._scan_axes[k - 2], angles)  # Scan axis turns with its mirror
+
     def set_ray(self, ray):
         """
         Initializes the ray to be traced through the system.
@@ -114,19 +264,20 @@ class MultiAxisGalvanometer:
         """
         self.ray = ray
 
-    def reflect(self, normal, point):
+    def reflect(self, normal, point, normalized=False):
         """
         Reflects the ray off a mirror using its normal vector and position.
 
         Parameters:
         - normal (list): Normal vector of the reflecting surface.
         - point (list): A point on the reflecting surface.
+        - normalized (bool): Whether the normal is already a unit vector, skipping its normalization.
 
         Notes:
         - The ray interacts with the mirror and then reflects off it.
         """
-        self.ray.interaction(normal, point)  # Interaction with the surface
-        self.ray.reflection(normal)  # Reflection based on the surface normal
+        self.ray.interaction(normal, point, normalized)  # Interaction with the surface
+        self.ray.reflection(normal, normalized)  # Reflection based on the surface normal
 
     def scan(self, Px1, Px2, nx, ny, nx_rotation, ny_rotation, x_angle, y_angle):
         """
@@ -147,7 +298,7 @@ class MultiAxisGalvanometer:
         """
         self.ray.scan(Px1, Px2, nx, ny, nx_rotation, ny_rotation, x_angle, y_angle)
 
-    def refract(self, normal, point, k=-1):
+    def refract(self, normal, point, k=-1, normalized=False):
         """
         Simulates refraction of the ray at the field lens.
 
@@ -155,62 +306,70 @@ class MultiAxisGalvanometer:
         - normal (list): Normal vector of the refracting surface (field lens).
         - point (list): A point on the refracting surface.
         - k (float): Refractive index (default is -1, representing a general refraction).
+        - normalized (bool): Whether the normal is already a unit vector, skipping its normalization.
 
         Notes:
         - The ray interacts with the surface and is refracted based on the refractive index and the surface normal.
         """
-        self.ray.interaction(normal, point)  # Interaction with the field lens
-        self.ray.refraction(k, normal) # Refraction based on our paper
+        self.ray.interaction(normal, point, normalized)  # Interaction with the field lens
+        self.ray.refraction(k, normal, normalized) # Refraction based on our paper
 
     def trace(self, X_angle, Y_angle):
         """
         Simulates the full ray tracing process through the multi-axis galvanometer system.
 
         Parameters:
-        - X_angle (float): Rotation angle of the X-axis mirror (in degrees).
-        - Y_angle (float): Rotation angle of the Y-axis mirror (in degrees).
+        - X_angle (float or np.array): Rotation angle of the X-axis mirror (in degrees).
+        - Y_angle (float or np.array): Rotation angle of the Y-axis mirror (in degrees).
 
         Returns:
-        - intersection_point (np.array): The final intersection point of the ray with the focusing plane.
-        """
+        - intersection_point (np.array): The final intersection point of the ray with the focusing plane,
+          or None if a single ray misses it.
 
+        Notes:
+        - When the ray holds a batch of N rays, X_angle and Y_angle are arrays of shape (N,) and every ray
+          is traced with its own pair of angles in a single call, returning an (N, 3) array of points.
+        - In a batch, the rays that miss a surface are NaN rows, as in trace_grid, so both give the same points
+          for the same grid.
+        - The surfaces are the ones built in __init__, with their normals already normalized.
+        """
+        (n1, P1), (n2, P2), (nx, Px1), (ny, Px2), (n5, P5), (n, P) = self._mirrors
+        rx, ry = self._scan_axes
 
         # Step 1: First Mirror (Pi_1)
-        # Step 1: First Mirror (Pi_1)
-        n1 = [0, 1, -1]  # Normal vector for the first mirror
-        # Use Rodrigues' rotation formula to rotate the normal vector, rotation variable rot=[0,0,0]
-        # n1 = rotate_normal_vector(n1, [1, 0, 0])
-
-        P1 = [0, 20, 0]  # Position of the first mirror
-        # Use affine transformation for translation, translation components [1,0,0] represent movement along the X, Y, and Z axes
-        # P1 = translate_position(P1, [1, 0, 0])
-        self.reflect(n1, P1)  # Reflect the ray from the first mirror
+        self.reflect(n1, P1, normalized=True)  # Reflect the ray from the first mirror
 
         # Step 2: Second Mirror (Pi_2)
-        n2 = [0, 1, -1]  # Normal vector for the second mirror
-        P2 = [0, 20, 200]  # Position of the second mirror
-        self.reflect(n2, P2)  # Reflect the ray from the second mirror
+        self.reflect(n2, P2, normalized=True)  # Reflect the ray from the second mirror
 
         # Step 3: X-Y Scanning mirrors
-        Px1 = [0, 180, 200]  # Position of the first scanning mirror
-        Px2 = [self.galvo_gap, 180, 200]  # Position of the second scanning mirror
-        nx = [-1, 1, 0]  # Normal vector for X scanning
-        ny = [1, 0, 1]  # Normal vector for Y scanning
-        rx = [0, 0, 1]  # Rotation axis for X mirror
-        ry = [0, 1, 0]  # Rotation axis for Y mirror
         self.scan(Px1, Px2, nx, ny, rx, ry, X_angle, Y_angle)  # Perform scanning operation
 
         # Step 4: Refraction at the field lens
-        n5 = [0, 0, 1]  # Normal vector for the field lens
-        P5 = [self.galvo_gap, 180, 170]  # Position of the field lens
-        self.refract(n5, P5)  # Simulate refraction at the field lens
+        self.refract(n5, P5, normalized=True)  # Simulate refraction at the field lens
 
         # Step 5: Intersection with the focusing plane (Final output point)
-        n = [0, 0, 1]  # Normal vector of the plane
-        P = [self.galvo_gap, 180, 170-self.focus_distance]
-        intersection_point = self.ray.interaction(n, P)
+        intersection_point = self.ray.interaction(n, P, normalized=True)
 
         return intersection_point
 
+    def trace_grid(self, valuex, valuey):
+        """
+        Traces a whole grid of X and Y mirror angles through the system in compiled code.
+
+        Parameters:
+        - valuex (np.array): Rotation angles of the X-axis mirror (in degrees).
+        - valuey (np.array): Rotation angles of the Y-axis mirror (in degrees).
+
+        Returns:
+        - points (np.array): The (len(valuex) * len(valuey), 3) intersection points with the focusing plane,
+          ordered with valuex as the outer axis. Rays that miss a surface are NaN, as in a batch trace.
+
+        Notes:
+        - Each ray starts at the origin along +Y, as in Test_Mechnical; the ray set with set_ray is not used.
+        """
+        return _trace_grid(np.asarray(valuex, dtype=np.float64), np.asarray(valuey, dtype=np.float64),
+                           self._mirrors, self._scan_axes)
+
 
 
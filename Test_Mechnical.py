@@ -31,63 +31,62 @@ Completion Date: 2024.06.21
 # This test file is used to generate a distribution map of points under mechanical error conditions.
 
 import GalvoGeo.MutiAxisParam as MA  # Import multi-axis galvanometer parameter module
-import RayData.Ray as ry  # Import Ray class for ray-tracing simulations
+import RayData.Ray as ry  # Import the Ray class to trace the points one by one
 import numpy as np  # Import numpy for numerical operations
 import Draw.DrawFile as df  # Import draw module to visualize the points
-import csv  # Import csv module to save data in CSV format
 
 
 def test(num):
-    intersection_point_list = []  # List to store the intersection points of the ray with the system
-
-    # Initialize a ray with an initial position and direction
-    initial_position = [0, 0, 0]  # Starting position of the ray (origin)
-    initial_direction = [0, 1, 0]  # Direction of the ray (in the positive Y-axis direction)
-    ray = ry.Ray(initial_position, initial_direction)  # Create the Ray object with the given initial conditions
+    # Generate a grid of X and Y values using linspace for a range of values, equally spaced
+    valuex = np.linspace(-11, 11, num)  # Create an array of X values from -11 to 11, with `num` points
+    valuey = np.linspace(-11, 11, num)  # Create an array of Y values from -11 to 11, with `num` points
 
     # Initialize the multi-axis galvanometer with focus distance and gap between mirrors
     focus_distance = 165  # The focus distance (example value)
     galvo_gap = 13.05  # The gap between the galvanometer mirrors (example value)
     mag = MA.MultiAxisGalvanometer(focus_distance, galvo_gap)  # Create a MultiAxisGalvanometer object
 
-    # Set the ray for the galvanometer system
-    mag.set_ray(ray)
-
-    # Generate a grid of X and Y values using linspace for a range of values, equally spaced
-    valuex = np.linspace(-11, 11, num)  # Create an array of X values from -11 to 11, with `num` points
-    valuey = np.linspace(-11, 11, num)  # Create an array of Y values from -11 to 11, with `num` points
-
-    # Iterate over each point in the generated grid (valuex, valuey)
-    for i in valuex:
-        for j in valuey:
-            ray = ry.Ray(initial_position, initial_direction)  # Re-initialize the ray for each point in the grid
-            mag = MA.MultiAxisGalvanometer(focus_distance, galvo_gap)  # Re-initialize the multi-axis galvanometer
-            mag.set_ray(ray)  # Set the new ray for the system
-
-            # Trace the ray through the system for the given X and Y angles (i, j)
-            intersection_point = mag.trace(i, j)
-            intersection_point_list.append(intersection_point)  # Store the intersection points
+    # Trace one ray per point of the (valuex, valuey) grid, starting at the origin along +Y, in a single compiled call
+    intersection_points = mag.trace_grid(valuex, valuey)
 
     P1 = [galvo_gap, 180, 5]  # A point on the plane (arbitrary chosen for reference)
     A = np.array(P1)  # Convert the point to a numpy array for easy vector operations
 
     # Subtract the reference point (A) from each intersection point to calculate the relative position
-    realresult = [point - A for point in intersection_point_list]  # Perform element-wise subtraction
+    realresult = intersection_points - A  # Broadcast the subtraction over the (N, 3) array of points
 
     # Save the results to a CSV file
     # Specify the path for the CSV file where the results will be saved
     csv_file_path = "realpoint_draw.csv"  # File name for storing the result data
 
-    # Write the data to the CSV file
+    # Write the data to the CSV file in one call, with the header row X, Y, Z and CSV-style line endings
+    # The file is opened with newline='' so the \r\n row endings are not translated again on Windows
     with open(csv_file_path, mode='w', newline='') as file:
-        writer = csv.writer(file)  # Create a CSV writer object
-        # Write the header row, with column names: X, Y, Z
-        writer.writerow(['X', 'Y', 'Z'])
-        # Write the actual data points
-        for point in realresult:
-            writer.writerow(point)
+        np.savetxt(file, realresult, fmt='%.8g', delimiter=',', newline='\r\n', header='X,Y,Z', comments='')
 
     print("CSV file has been created:", csv_file_path)  # Print a message indicating the CSV file creation
 
     # Visualize the result by plotting the 2D points (X, Y positions)
     df.plot_2d_points(realresult)  # Plot the points using the drawing module
+
+
+def test_ray_reuse(num):
+    # Check that one Ray and one galvanometer reused with Ray.reset give the same points as a batch traced in one call
+    valuex = np.linspace(-11, 11, num)  # X angles of the grid
+    valuey = np.linspace(-11, 11, num)  # Y angles of the grid
+    X, Y = np.meshgrid(valuex, valuey, indexing='ij')  # One (X, Y) pair per point, X varying slowest
+    X, Y = X.ravel(), Y.ravel()
+
+    mag = MA.MultiAxisGalvanometer(165, 13.05)
+    mag.set_ray(ry.Ray(np.tile([0, 0, 0], (len(X), 1)), np.tile([0, 1, 0], (len(X), 1))))
+    expected = mag.trace(X, Y)  # Reference points, one row per ray of the batch
+
+    ray = ry.Ray([0, 0, 0], [0, 1, 0])  # The single ray reused for every point
+    mag.set_ray(ray)
+    points = []
+    for i, j in zip(X, Y):
+        ray.reset([0, 0, 0], [0, 1, 0])  # Put the ray back to the origin before every trace
+        points.append(mag.trace(i, j))  # Keep the returned point, a later reset must not overwrite it
+
+    assert np.allclose(np.array(points), expected), "Reused ray gives different points than the batch trace"
+    print("Reused ray matches the batch trace for", len(X), "points")
@@ -7,6 +7,7 @@ import Test.Test_Mechnical as ts
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
+    ts.test_ray_reuse(11)  # Check that a reused Ray traces the same points as a batch
     ts.test(11)
 
 # See PyCharm help at https://www.jetbrains.com/help/pycharm/
@@ -0,0 +1,326 @@
+'''
+Copyright (c) 2024, HUST All rights reserved
+
+File Name: ray_kernels.py
+Summary:
+    This file contains the numba-compiled kernels behind the `Ray` class: ray-plane intersection, reflection, refraction and the Rodrigues' rotation of a vector around an axis. Every kernel works on flat 3-vectors with explicit scalar expressions and returns a tuple, so it can be called from other compiled functions without allocating arrays.
+
+Running Environment: Python 3.6 or later, numba
+
+Modification Description:
+    The single-ray kernels (`interact`, `reflect`, `refract`, `rotate_axis`) hold the ray-tracing math; `interact`, `reflect` and `refract` expect unit normal vectors, which `normalize` provides. The `*_many` kernels apply them row by row to (N, 3) arrays and are the entry points used by the `Ray` methods. The math runs in float64 and the results are stored with the dtype of the ray arrays, so float32 batches move half the memory.
+
+Current Version: 1.0
+
+Modified By: Tianz
+
+Modification Details:
+    - Moved the hot ray-tracing math out of `Ray` into numba `@njit` kernels.
+    - Replaced `np.dot`/`np.linalg.norm` on 3-vectors with explicit scalar expressions.
+    - Added row-wise kernels for batches of rays.
+    - Pre-normalized normal vectors skip the normalization in the kernels.
+
+Modification Date: [Insert Date]
+
+Original Author: Tianz
+
+Completion Date: 2026.10.14
+'''
+
+import math
+
+import numpy as np
+from numba import njit
+
+
+'''
+Function name: normalize
+Function description:
+    Scales a 3D vector to unit length.
+
+Input parameters:
+    v (np.array): The vector to normalize.
+
+Output parameters:
+    tuple: The unit vector (x, y, z).
+'''
+@njit(cache=True)
+def normalize(v):
+    inv = 1.0 / math.sqrt(v[0] * v[0] + v[1] * v[1] + v[2] * v[2])
+    return (v[0] * inv, v[1] * inv, v[2] * inv)
+
+
+
+'''
+Function name: interact
+Function description:
+    Computes the point of intersection between a single ray and a plane.
+
+Input parameters:
+    pos (np.array): The position of the ray, a 3D vector.
+    dirn (np.array): The unit direction of the ray, a 3D vector.
+    n (np.array): The unit normal vector of the plane.
+    P (np.array): A point on the plane.
+
+Output parameters:
+    tuple: The new position (x, y, z) and a flag telling whether the ray hits the plane.
+
+Notes:
+    If the ray is parallel to the plane or the plane is behind the ray, the position is returned unchanged with the flag set to False.
+'''
+@njit(cache=True)
+def interact(pos, dirn, n, P):
+    nx = n[0]
+    ny = n[1]
+    nz = n[2]
+    denominator = dirn[0] * nx + dirn[1] * ny + dirn[2] * nz
+    if abs(denominator) < 1e-10:
+        return (float(pos[0]), float(pos[1]), float(pos[2])), False  # The ray is parallel to the plane
+    t = ((P[0] - pos[0]) * nx + (P[1] - pos[1]) * ny + (P[2] - pos[2]) * nz) / denominator
+    if t < 0:
+        return (float(pos[0]), float(pos[1]), float(pos[2])), False  # The intersection point is behind the ray's origin
+    return (pos[0] + t * dirn[0], pos[1] + t * dirn[1], pos[2] + t * dirn[2]), True
+
+
+
+'''
+Function name: reflect
+Function description:
+    Reflects a single direction vector on a surface with normal vector n.
+
+Input parameters:
+    dirn (np.array): The direction of the ray, a 3D vector.
+    n (np.array): The unit normal vector of the reflecting surface.
+
+Output parameters:
+    tuple: The reflected direction (x, y, z).
+'''
+@njit(cache=True)
+def reflect(dirn, n):
+    nx = n[0]
+    ny = n[1]
+    nz = n[2]
+    d2 = 2.0 * (dirn[0] * nx + dirn[1] * ny + dirn[2] * nz)
+    return (dirn[0] - d2 * nx, dirn[1] - d2 * ny, dirn[2] - d2 * nz)
+
+
+
+'''
+Function name: refract
+Function description:
+    Refracts a single direction vector on a surface with normal vector n and refractive index k.
+
+Input parameters:
+    dirn (np.array): The unit direction of the ray, a 3D vector.
+    n (np.array): The unit normal vector of the refracting surface.
+    k (float): The refractive index.
+
+Output parameters:
+    tuple: The refracted unit direction (x, y, z).
+
+Notes:
+    The angle of incidence theta is taken as atan2(sin_theta, cos_theta), where sin_theta is the length of the
+    direction component parallel to the surface. Unlike acos(cos_theta) this stays accurate near normal incidence,
+    and sin_theta also normalizes the parallel component.
+    At normal incidence the parallel component vanishes and the ray leaves along -n.
+'''
+@njit(cache=True)
+def refract(dirn, n, k):
+    nx = n[0]
+    ny = n[1]
+    nz = n[2]
+    cos_theta = -(dirn[0] * nx + dirn[1] * ny + dirn[2] * nz)  # Cosine of the angle of incidence
+    # Direction component parallel to the surface, of length sin_theta
+    px = dirn[0] + cos_theta * nx
+    py = dirn[1] + cos_theta * ny
+    pz = dirn[2] + cos_theta * nz
+    sin_theta = math.sqrt(px * px + py * py + pz * pz)
+    if sin_theta == 0:
+        return (-nx, -ny, -nz)  # Normal incidence
+    theta = math.atan2(sin_theta, cos_theta)
+    vertical = 1.0 / math.sqrt(1 + k * k * theta * theta)
+    term1 = k * theta * vertical / sin_theta
+    # Combine the vertical and parallel components, then normalize
+    rx = -vertical * nx + term1 * px
+    ry = -vertical * ny + term1 * py
+    rz = -vertical * nz + term1 * pz
+    inv = 1.0 / math.sqrt(rx * rx + ry * ry + rz * rz)
+    return (rx * inv, ry * inv, rz * inv)
+
+
+
+'''
+Function name: refract_k_minus_one
+Function description:
+    Refracts a single direction vector on a surface with normal vector n, for the refractive index k = -1.
+
+Input parameters:
+    dirn (np.array): The unit direction of the ray, a 3D vector.
+    n (np.array): The unit normal vector of the refracting surface.
+
+Output parameters:
+    tuple: The refracted unit direction (x, y, z).
+
+Notes:
+    Same result as `refract(dirn, n, -1.0)`, which is the field lens used by MultiAxisGalvanometer.
+    With k * k = 1 the vertical and parallel weights are 1 / sqrt(1 + theta^2) and -theta / sqrt(1 + theta^2).
+    Their squares add up to one and the two unit components are orthogonal, so the result needs no final normalization.
+    theta is computed with atan2 as in `refract`.
+'''
+@njit(cache=True)
+def refract_k_minus_one(dirn, n):
+    nx = n[0]
+    ny = n[1]
+    nz = n[2]
+    cos_theta = -(dirn[0] * nx + dirn[1] * ny + dirn[2] * nz)  # Cosine of the angle of incidence
+    # Direction component parallel to the surface, of length sin_theta
+    px = dirn[0] + cos_theta * nx
+    py = dirn[1] + cos_theta * ny
+    pz = dirn[2] + cos_theta * nz
+    sin_theta = math.sqrt(px * px + py * py + pz * pz)
+    if sin_theta == 0:
+        return (-nx, -ny, -nz)  # Normal incidence
+    theta = math.atan2(sin_theta, cos_theta)
+    vertical = 1.0 / math.sqrt(1 + theta * theta)
+    # Parallel component, scaled to length theta / sqrt(1 + theta^2) and pointing against the incoming one
+    term1 = theta * vertical / sin_theta
+    return (-vertical * nx - term1 * px, -vertical * ny - term1 * py, -vertical * nz - term1 * pz)
+
+
+
+'''
+Function name: rotate_axis
+Function description:
+    Rotates a vector around a given axis by an angle theta using Rodrigues' rotation formula.
+
+Input parameters:
+    vec (np.array): The vector to be rotated.
+    axis (np.array): The axis of rotation, a 3D vector.
+    theta (float): The angle of rotation in radians.
+
+Output parameters:
+    tuple: The rotated unit vector (x, y, z).
+
+Notes:
+    The input vector and axis are normalized to unit vectors before applying the rotation formula.
+'''
+@njit(cache=True)
+def rotate_axis(vec, axis, theta):
+    inv = 1.0 / math.sqrt(vec[0] * vec[0] + vec[1] * vec[1] + vec[2] * vec[2])  # Normalize the vector
+    vx = vec[0] * inv
+    vy = vec[1] * inv
+    vz = vec[2] * inv
+    inv = 1.0 / math.sqrt(axis[0] * axis[0] + axis[1] * axis[1] + axis[2] * axis[2])  # Normalize the axis
+    ax = axis[0] * inv
+    ay = axis[1] * inv
+    az = axis[2] * inv
+    c = math.cos(theta)
+    s = math.sin(theta)
+    a_dot_v = (ax * vx + ay * vy + az * vz) * (1 - c)
+    return (vx * c + (ay * vz - az * vy) * s + ax * a_dot_v,
+            vy * c + (az * vx - ax * vz) * s + ay * a_dot_v,
+            vz * c + (ax * vy - ay * vx) * s + az * a_dot_v)
+
+
+
+'''
+Function name: interact_many
+Function description:
+    Applies `interact` to every row of a batch of rays.
+
+Input parameters:
+    pos (np.array): The positions of the rays, shape (N, 3).
+    dirn (np.array): The unit directions of the rays, shape (N, 3).
+    n (np.array): The normal vector of the plane for every ray, shape (N, 3).
+    P (np.array): A point on the plane.
+    normalized (bool): Whether the normal vectors are already unit vectors.
+
+Output parameters:
+    tuple: The (N, 3) array of new positions and the (N,) array of hit flags.
+'''
+@njit(cache=True)
+def interact_many(pos, dirn, n, P, normalized):
+    out = np.empty((pos.shape[0], 3), dtype=pos.dtype)
+    hit = np.empty(pos.shape[0], dtype=np.bool_)
+    for i in range(pos.shape[0]):
+        n_i = (n[i, 0], n[i, 1], n[i, 2]) if normalized else normalize(n[i])
+        new_pos, hit[i] = interact(pos[i], dirn[i], n_i, P)
+        out[i, 0] = new_pos[0]
+        out[i, 1] = new_pos[1]
+        out[i, 2] = new_pos[2]
+    return out, hit
+
+
+
+'''
+Function name: reflect_many
+Function description:
+    Applies `reflect` to every row of a batch of directions.
+
+Input parameters:
+    dirn (np.array): The directions of the rays, shape (N, 3).
+    n (np.array): The normal vector of the reflecting surface for every ray, shape (N, 3).
+    normalized (bool): Whether the normal vectors are already unit vectors.
+
+Output parameters:
+    np.array: The (N, 3) array of reflected directions.
+'''
+@njit(cache=True)
+def reflect_many(dirn, n, normalized):
+    out = np.empty((dirn.shape[0], 3), dtype=dirn.dtype)
+    for i in range(dirn.shape[0]):
+        n_i = (n[i, 0], n[i, 1], n[i, 2]) if normalized else normalize(n[i])
+        out[i, 0], out[i, 1], out[i, 2] = reflect(dirn[i], n_i)
+    return out
+
+
+
+'''
+Function name: refract_many
+Function description:
+    Applies `refract` to every row of a batch of directions.
+
+Input parameters:
+    dirn (np.array): The unit directions of the rays, shape (N, 3).
+    n (np.array): The normal vector of the refracting surface for every ray, shape (N, 3).
+    k (float): The refractive index.
+    normalized (bool): Whether the normal vectors are already unit vectors.
+
+Output parameters:
+    np.array: The (N, 3) array of refracted directions.
+
+Notes:
+    k = -1 takes the `refract_k_minus_one` path.
+'''
+@njit(cache=True)
+def refract_many(dirn, n, k, normalized):
+    out = np.empty((dirn.shape[0], 3), dtype=dirn.dtype)
+    for i in range(dirn.shape[0]):
+        n_i = (n[i, 0], n[i, 1], n[i, 2]) if normalized else normalize(n[i])
+        if k == -1:
+            out[i, 0], out[i, 1], out[i, 2] = refract_k_minus_one(dirn[i], n_i)
+        else:
+            out[i, 0], out[i, 1], out[i, 2] = refract(dirn[i], n_i, k)
+    return out
+
+
+
+'''
+Function name: rotate_axis_many
+Function description:
+    Applies `rotate_axis` to every row of a batch of vectors, each with its own angle.
+
+Input parameters:
+    vec (np.array): The vectors to be rotated, shape (N, 3).
+    axis (np.array): The axis of rotation, a 3D vector.
+    theta (np.array): The angles of rotation in radians, shape (N,).
+
+Output parameters:
+    np.array: The (N, 3) array of rotated vectors.
+'''
+@njit(cache=True)
+def rotate_axis_many(vec, axis, theta):
+    out = np.empty((vec.shape[0], 3))
+    for i in range(vec.shape[0]):
+        out[i, 0], out[i, 1], out[i, 2] = rotate_axis(vec[i], axis, theta[i])
+    return out